@@ -45,10 +45,12 @@ def _rect_bounds_from_tensors(
     """
     # Generate mask (all points with maximum likelihood ratio above threshold are kept)
     mask = logratios - logratios.max(axis=0).values > np.log(threshold)
-    par_max = params.max(dim=0).values
-    par_min = params.min(dim=0).values
-    constr_min = torch.where(mask.unsqueeze(-1), params, par_max).min(dim=0).values
-    constr_max = torch.where(mask.unsqueeze(-1), params, par_min).max(dim=0).values
+    mask = mask.unsqueeze(-1)
+    # The maximum itself is always selected, so masked points can simply be
+    # filled with -/+inf instead of the full-range extrema
+    inf = params.new_tensor(np.inf)
+    constr_min = torch.where(mask, params, inf).amin(dim=0)
+    constr_max = torch.where(mask, params, -inf).amax(dim=0)
     return torch.stack([constr_min, constr_max], dim=-1)
 
 
@@ -1,3 +1,4 @@
+import math
 from dataclasses import dataclass, field
 from toolz.dicttoolz import valmap
 from typing import (
@@ -51,20 +52,20 @@ from scipy.ndimage import gaussian_filter1d, gaussian_filter
 #############
 
 
+# Expected loss per ratio estimator for an untrained classifier (f = 0)
+_TWO_LOG_TWO = 2 * math.log(2.0)
+
+
 class LossAggregationSteps:
     def _get_logratios(self, out):
         if isinstance(out, dict):
             out = {k: v for k, v in out.items() if k[:4] != "aux_"}
-            logratios = torch.cat(
-                [val.logratios.flatten(start_dim=1) for val in out.values()], dim=1
-            )
+            logratios = _cat_logratios(out.values())
         elif isinstance(out, list) or isinstance(out, tuple):
             out = [v for v in out if hasattr(v, "logratios")]
             if out == []:
                 return None
-            logratios = torch.cat(
-                [val.logratios.flatten(start_dim=1) for val in out], dim=1
-            )
+            logratios = _cat_logratios(out)
         elif isinstance(out, swyft.LogRatioSamples):
             logratios = out.logratios.flatten(start_dim=1)
         else:
@@ -80,6 +81,17 @@ class LossAggregationSteps:
             losses = torch.cat([v.loss.unsqueeze(-1) for v in filtered_out], dim=1)
             return losses
 
+    def _get_loss_buffer(self, key, init_fn):
+        """Return tensor cached under key, creating it with init_fn if needed.
+
+        Used to reuse contrastive batches across training steps.
+        """
+        if not hasattr(self, "_loss_buffers"):
+            self._loss_buffers = {}
+        if key not in self._loss_buffers:
+            self._loss_buffers[key] = init_fn()
+        return self._loss_buffers[key]
+
     def _calc_loss(self, batch, randomized=True):
         """Calcualte batch-averaged loss summed over ratio estimators.
 
@@ -93,13 +105,25 @@ class LossAggregationSteps:
             B = batch[1]
         else:  # only one dataloader provided, using same samples for constrative samples
             A = batch
-            B = valmap(lambda z: torch.roll(z, 1, dims=0), A)
+            B = None
 
         # Concatenate positive samples and negative (contrastive) examples
         x = A
         z = {}
-        for key in B:
-            z[key] = torch.cat([A[key], B[key]])
+        for key in A if B is None else B:
+            n = len(A[key])
+            m = n if B is None else len(B[key])
+            shape = (n + m, *A[key].shape[1:])
+            z[key] = self._get_loss_buffer(
+                ("z", key, shape, A[key].dtype, A[key].device),
+                lambda: torch.empty(shape, dtype=A[key].dtype, device=A[key].device),
+            )
+            z[key][:n].copy_(A[key])
+            if B is None:  # Equivalent to torch.roll(A[key], 1, dims=0)
+                z[key][n].copy_(A[key][-1])
+                z[key][n + 1 :].copy_(A[key][:-1])
+            else:
+                z[key][n:].copy_(B[key])
 
         num_pos = len(list(x.values())[0])  # Number of positive examples
         num_neg = len(list(z.values())[0]) - num_pos  # Number of negative examples
@@ -111,15 +135,15 @@ class LossAggregationSteps:
             out
         )  # Generates concatenated flattened list of all estimated log ratios
         if logratios is not None:
-            y = torch.zeros_like(logratios)
-            y[:num_pos, ...] = 1
-            pos_weight = torch.ones_like(logratios[0]) * num_neg / num_pos
-            loss = F.binary_cross_entropy_with_logits(
-                logratios, y, reduction="none", pos_weight=pos_weight
+            # Binary cross-entropy, positive examples weighted by num_neg/num_pos
+            pos_weight = num_neg / num_pos
+            loss = (
+                -pos_weight * F.logsigmoid(logratios[:num_pos]).sum()
+                - F.logsigmoid(-logratios[num_pos:]).sum()
             )
-            num_ratios = loss.shape[1]
-            loss = loss.sum() / num_neg  # Calculates batched-averaged loss
-            loss = loss - 2 * np.log(2.0) * num_ratios
+            num_ratios = logratios.shape[1]
+            loss = loss / num_neg  # Calculates batched-averaged loss
+            loss = loss - _TWO_LOG_TWO * num_ratios
             loss_tot += loss
 
         aux_losses = self._get_aux_losses(out)
@@ -149,6 +173,14 @@ class LossAggregationSteps:
         return self(A, B)
 
 
+def _cat_logratios(lrs):
+    """Concatenate flattened logratios, without copying a single estimator."""
+    logratios = [val.logratios.flatten(start_dim=1) for val in lrs]
+    if len(logratios) == 1:
+        return logratios[0]
+    return torch.cat(logratios, dim=1)
+
+
 class SwyftModule(
     AdamW, OnFitEndLoadBestModel, LossAggregationSteps, pl.LightningModule
 ):
@@ -300,14 +332,16 @@ class SwyftTrainer(pl.Trainer):
         Returns:
             Concatenated network output
         """
-        if isinstance(A, Sample):
-            dl1 = Samples({k: [v] for k, v in A.items()}).get_dataloader(batch_size=1)
+        if isinstance(A, Sample):  # Collate once, reused for every cycle
+            batch = torch.utils.data.dataloader.default_collate([A])
+            dl1 = torch.utils.data.DataLoader([batch], batch_size=None)
         elif isinstance(A, Samples):
             dl1 = A.get_dataloader(batch_size=batch_size)
         else:
             dl1 = A
-        if isinstance(B, Sample):
-            dl2 = Samples({k: [v] for k, v in B.items()}).get_dataloader(batch_size=1)
+        if isinstance(B, Sample):  # Collate once, reused for every cycle
+            batch = torch.utils.data.dataloader.default_collate([B])
+            dl2 = torch.utils.data.DataLoader([batch], batch_size=None)
         elif isinstance(B, Samples):
             dl2 = B.get_dataloader(batch_size=batch_size)
         else:
@@ -382,17 +416,8 @@ class SwyftTrainer(pl.Trainer):
             ratios = p1.logratios.reshape(
                 n0, -1, *p1.logratios.shape[1:]
             )  # (n_examples, n_samples_per_example, *per_event_ratio_shape)
-            vs = []
-            ms = []
-            for i in range(n0):
-                ratio0 = p0.logratios[i]
-                value0 = p0.params[i]
-                m = _calc_mass(ratio0, ratios[i], add_noise=logratio_noise)
-                vs.append(value0)
-                ms.append(m)
-            masses = torch.stack(ms, dim=0)
-            params = torch.stack(vs, dim=0)
-            out = CoverageSamples(masses, params, p0.parnames)
+            masses = _calc_mass(p0.logratios, ratios, add_noise=logratio_noise)
+            out = CoverageSamples(masses, p0.params, p0.parnames)
             return out
 
         if isinstance(pred0, tuple):
@@ -408,13 +433,18 @@ class SwyftTrainer(pl.Trainer):
 
 
 def _calc_mass(r0, r, add_noise=False):
+    """Probability mass of samples with log-ratios above r0.
+
+    Args:
+        r0: Log-ratios of the reference points, (n_examples, *logratios_shape)
+        r: Log-ratios of the samples, (n_examples, n_samples, *logratios_shape)
+    """
     if add_noise:
         r = r + torch.rand_like(r) * 1e-3
         r0 = r0 + torch.rand_like(r0) * 1e-3
-    p = torch.exp(r - r.max(axis=0).values)
-    p /= p.sum(axis=0)
-    m = r > r0
-    return (p * m).sum(axis=0)
+    p = torch.softmax(r, dim=1)
+    m = r > r0.unsqueeze(1)
+    return (p * m).sum(axis=1)
 
 
 #################
@@ -1,4 +1,5 @@
 import math
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Callable,
     Dict,
@@ -34,6 +35,9 @@ class SwyftDataModule(pl.LightningDataModule):
         batch_size: Minibatch size.
         num_workers: Number of workers for dataloader.
         shuffle: Shuffle training data.
+        on_after_load_sample: Optional function applied to each training sample.
+        persistent_workers: Keep workers alive between epochs (if num_workers > 0).
+        prefetch_factor: Number of batches loaded in advance by each worker.
 
     Returns:
         pytorch_lightning.LightningDataModule
@@ -49,6 +53,8 @@ class SwyftDataModule(pl.LightningDataModule):
         num_workers: int = 0,
         shuffle: bool = False,
         on_after_load_sample: Optional[callable] = None,
+        persistent_workers: bool = True,
+        prefetch_factor: int = 2,
     ):
         super().__init__()
         self.data = data
@@ -73,6 +79,8 @@ class SwyftDataModule(pl.LightningDataModule):
         self.num_workers = num_workers
         self.shuffle = shuffle
         self.on_after_load_sample = on_after_load_sample
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
     @staticmethod
     def _get_lengths(fractions, N):
@@ -106,21 +114,26 @@ class SwyftDataModule(pl.LightningDataModule):
         else:
             raise ValueError
 
+    def _get_worker_kwargs(self):
+        return _get_worker_kwargs(
+            self.num_workers, self.persistent_workers, self.prefetch_factor
+        )
+
     def train_dataloader(self):
         dataloader = torch.utils.data.DataLoader(
-            self.dataset_train,
-            batch_size=self.batch_size,
-            shuffle=self.shuffle,
+            **_get_loader_kwargs(self.dataset_train, self.batch_size, self.shuffle),
+            collate_fn=_collate_samples,
             num_workers=self.num_workers,
+            **self._get_worker_kwargs(),
         )
         return dataloader
 
     def val_dataloader(self):
         dataloader = torch.utils.data.DataLoader(
-            self.dataset_val,
-            batch_size=self.batch_size,
-            shuffle=False,
+            **_get_loader_kwargs(self.dataset_val, self.batch_size),
+            collate_fn=_collate_samples,
             num_workers=self.num_workers,
+            **self._get_worker_kwargs(),
         )
         return dataloader
 
@@ -137,23 +150,83 @@ class SwyftDataModule(pl.LightningDataModule):
 #        return dataloader
 
 
+def _get_worker_kwargs(num_workers, persistent_workers, prefetch_factor):
+    """DataLoader options that are only valid in combination with workers."""
+    if num_workers == 0:
+        return {}
+    return dict(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+
+
 class SamplesDataset(torch.utils.data.Dataset):
     """Simple torch dataset based on Samples."""
 
     def __init__(self, sample_store, on_after_load_sample=None):
         self._dataset = sample_store
         self._on_after_load_sample = on_after_load_sample
+        self._batchable = on_after_load_sample is None and all(
+            isinstance(v, torch.Tensor)
+            or (isinstance(v, np.ndarray) and v.dtype.kind in "biufc")
+            for v in sample_store.values()
+        )
 
     def __len__(self):
         return len(self._dataset[list(self._dataset.keys())[0]])
 
     def __getitem__(self, i):
+        """Returns sample i.
+
+        For a list of indices, array and tensor columns are indexed in one go
+        and a dict of batched columns is returned.  Otherwise, and when
+        `on_after_load_sample` is set, a list of individual samples is returned.
+        """
+        if isinstance(i, list) and not self._batchable:
+            return [self[j] for j in i]
         d = {k: v[i] for k, v in self._dataset.items()}
         if self._on_after_load_sample is not None:
             d = self._on_after_load_sample(d)
         return d
 
 
+def _get_loader_kwargs(dataset, batch_size, shuffle=False):
+    """DataLoader arguments that let a SamplesDataset, or a Subset of one,
+    assemble whole batches at once.  Use together with `_collate_samples`.
+
+    Other datasets are loaded sample by sample.
+    """
+    indices = None
+    if isinstance(dataset, torch.utils.data.Subset):
+        if isinstance(dataset.dataset, SamplesDataset):
+            dataset, indices = dataset.dataset, list(dataset.indices)
+    if not isinstance(dataset, SamplesDataset):
+        return dict(dataset=dataset, batch_size=batch_size, shuffle=shuffle)
+    if indices is None:
+        indices = range(len(dataset))
+    sampler = torch.utils.data.SubsetRandomSampler(indices) if shuffle else indices
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+    return dict(dataset=dataset, batch_size=None, sampler=batch_sampler)
+
+
+def _collate_samples(batch):
+    """Collate function that also accepts batches that were already assembled
+    by `SamplesDataset.__getitem__` from a list of indices.
+
+    Samples with only numerical numpy values are stacked key by key with
+    `np.stack`, everything else goes through the default collate function.
+    """
+    if isinstance(batch, dict):
+        return {k: torch.as_tensor(v) for k, v in batch.items()}
+    if _is_numpy_sample(batch[0]):
+        return {k: torch.from_numpy(np.stack([s[k] for s in batch])) for k in batch[0]}
+    return torch.utils.data.dataloader.default_collate(batch)
+
+
+def _is_numpy_sample(sample):
+    return isinstance(sample, dict) and all(
+        isinstance(v, (np.ndarray, np.generic)) and v.dtype.kind in "biufc"
+        for v in sample.values()
+    )
+
+
 class RepeatDatasetWrapper(torch.utils.data.Dataset):
     def __init__(self, dataset, repeat):
         self._dataset = dataset
@@ -181,6 +254,10 @@ class ZarrStore:
         self.store = zarr.DirectoryStore(file_path)
         self.root = zarr.group(store=self.store, synchronizer=synchronizer)
         self.lock = fasteners.InterProcessLock(file_path + ".lock.file")
+        self._cached_len = None
+        # Cached indices of unfilled slots, consumed from _pending_pos onwards
+        self._pending_idx = None
+        self._pending_pos = 0
 
     def reset_length(self, N, clubber=False):
         """Resize store.  N >= current store length."""
@@ -193,21 +270,29 @@ class ZarrStore:
             shape = self.data[k].shape
             self.data[k].resize(N, *shape[1:])
         self.root["meta/sim_status"].resize(N,)
+        self._cached_len = N
+        self._pending_idx = None
 
     def init(self, N, chunk_size, shapes=None, dtypes=None):
         if len(self) > 0:
             print("WARNING: Already initialized.")
             return self
         self._init_shapes(shapes, dtypes, N, chunk_size)
+        self._pending_idx = None
         return self
 
     def __len__(self):
+        # The status array is resized last, so its length tells if the cache is stale
+        if self._cached_len is not None:
+            if len(self.root["meta/sim_status"]) == self._cached_len:
+                return self._cached_len
         if "data" not in self.root.keys():
             return 0
         keys = self.root["data"].keys()
         ns = [len(self.root["data"][k]) for k in keys]
         N = ns[0]
         assert all([n == N for n in ns])
+        self._cached_len = N
         return N
 
     def keys(self):
@@ -244,8 +329,13 @@ class ZarrStore:
                 ), "Inconsistent chunk sizes"
                 assert self.root["data/" + k].dtype == dtype, "Inconsistent dtype"
         try:
+            # Stored uncompressed, since the status array is scanned frequently
             self.root.zeros(
-                "meta/sim_status", shape=(N,), chunks=(chunk_size,), dtype="i4"
+                "meta/sim_status",
+                shape=(N,),
+                chunks=(chunk_size,),
+                dtype="i4",
+                compressor=None,
             )
         except zarr.errors.ContainsArrayError:
             assert self.root["meta/sim_status"].shape == (
@@ -255,6 +345,7 @@ class ZarrStore:
             assert self.chunk_size == chunk_size, "Inconsistent chunk size"
         except KeyError:
             self.data.attrs["chunk_size"] = chunk_size
+        self._cached_len = N
 
     @property
     def chunk_size(self):
@@ -276,21 +367,27 @@ class ZarrStore:
 
     @property
     def sims_required(self):
-        return sum(self.root["meta"]["sim_status"][:] == 0)
+        # Always read from the store, which may be filled or resized by other processes
+        status = self.root["meta"]["sim_status"][:]
+        return int(np.count_nonzero(status == 0))
 
     def simulate(self, sampler, max_sims=None, batch_size=10, progress_bar=True):#, targets=[]):
         total_sims = 0
         if isinstance(sampler, swyft.Simulator):
             sampler = sampler.sample
-        while self.sims_required > 0:
+        while True:
+            # Read the status array once per batch
+            sims_required = self.sims_required
+            if sims_required == 0:
+                break
             if max_sims is not None and total_sims >= max_sims:
                 break
-            num_sims = self._simulate_batch(sampler, batch_size,progress_bar=progress_bar)#, targets=targets)
+            num_sims = self._simulate_batch(sampler, batch_size, sims_required, progress_bar=progress_bar)#, targets=targets)
             total_sims += num_sims
 
-    def _simulate_batch(self, sample_fn, batch_size, progress_bar=True):#, targets=[]):
+    def _simulate_batch(self, sample_fn, batch_size, sims_required, progress_bar=True):#, targets=[]):
         # Run simulator
-        num_sims = min(batch_size, self.sims_required)
+        num_sims = min(batch_size, sims_required)
         if num_sims == 0:
             return num_sims
         
@@ -304,9 +401,17 @@ class ZarrStore:
             sim_status = self.root["meta"]["sim_status"]
             data = self.root["data"]
 
-            idx = np.arange(len(sim_status))[sim_status[:] == 0][:num_sims]
+            idx = self._reserve_slots(sim_status, num_sims)
             index_slices = _get_index_slices(idx)
 
+            if len(index_slices) > 1:
+                # Fragmented free slots: one write per key instead of per run
+                n = len(idx)
+                sim_status.set_coordinate_selection(idx, 1)
+                for k, v in data.items():
+                    v.set_orthogonal_selection(idx, samples[k][:n])
+                return num_sims
+
             for i_slice, j_slice in index_slices:
                 sim_status[j_slice[0] : j_slice[1]] = 1
                 for k, v in data.items():
@@ -316,6 +421,26 @@ class ZarrStore:
 
         return num_sims
 
+    def _reserve_slots(self, sim_status, num_sims):
+        """Returns indices of up to num_sims unfilled slots.
+
+        Must be called while holding the lock.  Free slots are taken from a
+        cached list of indices.  The full status array is only rescanned when
+        that list is exhausted, or when other processes have filled or resized
+        the store in the meantime.
+        """
+        if self._pending_idx is not None:
+            i0 = self._pending_pos
+            idx = self._pending_idx[i0 : i0 + num_sims]
+            if len(idx) == num_sims and idx[-1] < len(sim_status):
+                if not sim_status.get_coordinate_selection(idx).any():
+                    self._pending_pos += num_sims
+                    return idx
+        self._pending_idx = np.flatnonzero(sim_status[:] == 0)
+        idx = self._pending_idx[:num_sims]
+        self._pending_pos = len(idx)
+        return idx
+
     def get_dataset(self, idx_range=None, on_after_load_sample=None):
         return ZarrStoreIterableDataset(
             self, idx_range=idx_range, on_after_load_sample=on_after_load_sample
@@ -329,16 +454,36 @@ class ZarrStore:
         drop_last=True,
         idx_range=None,
         on_after_load_sample=None,
+        persistent_workers=True,
+        prefetch_factor=2,
     ):
-        ds = self.get_dataset(
-            idx_range=idx_range, on_after_load_sample=on_after_load_sample
-        )
+        """Returns a DataLoader over the store.
+
+        Each worker reads a disjoint set of zarr chunks.  Without
+        `on_after_load_sample`, batches are assembled directly from those chunks.
+        """
+        if on_after_load_sample is None:
+            # Batches are assembled by the dataset, directly from zarr chunks
+            ds = ZarrStoreIterableDataset(
+                self,
+                idx_range=idx_range,
+                batch_size=batch_size,
+                drop_last=drop_last,
+                pin_memory=pin_memory,
+            )
+            batch_size, drop_last = None, False
+        else:
+            ds = self.get_dataset(
+                idx_range=idx_range, on_after_load_sample=on_after_load_sample
+            )
         dl = torch.utils.data.DataLoader(
             ds,
             num_workers=num_workers,
             batch_size=batch_size,
             drop_last=drop_last,
             pin_memory=pin_memory,
+            collate_fn=_collate_samples,
+            **_get_worker_kwargs(num_workers, persistent_workers, prefetch_factor),
         )
         return dl
 
@@ -346,23 +491,41 @@ class ZarrStore:
 def _get_index_slices(idx):
     """Returns list of enumerated consecutive indices"""
     idx = np.array(idx)
-    pointer = 0
-    residual_idx = idx
-    slices = []
-    while len(residual_idx) > 0:
-        mask = residual_idx - residual_idx[0] - np.arange(len(residual_idx)) == 0
-        slc1 = [residual_idx[mask][0], residual_idx[mask][-1] + 1]
-        slc2 = [pointer, pointer + sum(mask)]
-        pointer += sum(mask)
-        slices.append([slc2, slc1])
-        residual_idx = residual_idx[~mask]
-    return slices
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks, len(idx)]
+    return [[[s, e], [idx[s], idx[e - 1] + 1]] for s, e in zip(starts, ends)]
 
 
 class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
+    """Iterable dataset that reads a ZarrStore chunk by chunk.
+
+    Args:
+        zarr_store: Store to read from.
+        idx_range: Optional (start, end) range of samples.
+        on_after_load_sample: Optional function applied to each sample.
+        batch_size: If set, yield batches of tensors instead of individual
+            samples (use together with `DataLoader(..., batch_size=None)`).
+            Not supported in combination with `on_after_load_sample`.
+        drop_last: Drop the last incomplete batch (only with `batch_size`).
+        pin_memory: Copy each chunk into pinned memory once, so that batches
+            can be moved to the GPU asynchronously (only with `batch_size`,
+            and only when loading in the main process).
+    """
+
     def __init__(
-        self, zarr_store: ZarrStore, idx_range=None, on_after_load_sample=None
+        self,
+        zarr_store: ZarrStore,
+        idx_range=None,
+        on_after_load_sample=None,
+        batch_size=None,
+        drop_last=False,
+        pin_memory=False,
     ):
+        if batch_size is not None and on_after_load_sample is not None:
+            raise ValueError("batch_size cannot be combined with on_after_load_sample.")
         self.zs = zarr_store
         if idx_range is None:
             self.n_samples = len(self.zs)
@@ -373,6 +536,9 @@ class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
         self.chunk_size = self.zs.chunk_size
         self.n_chunks = int(math.ceil(self.n_samples / float(self.chunk_size)))
         self.on_after_load_sample = on_after_load_sample
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory
 
     @staticmethod
     def get_idx(n_chunks, worker_info):
@@ -389,18 +555,39 @@ class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
             idx = np.random.permutation(n_chunks)
         return idx
 
+    def _load_chunk(self, i0):
+        offset = self.offset
+        return {
+            k: self.zs.data[k][
+                offset + i0 * self.chunk_size : offset + (i0 + 1) * self.chunk_size
+            ]
+            for k in self.zs.data.keys()
+        }
+
+    def _iter_chunks(self, idx):
+        """Yields chunks in order, reading the next one in a background thread."""
+        if len(idx) == 0:
+            return
+        # A single thread per (worker) process, to not oversubscribe
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self._load_chunk, idx[0])
+            for i0 in idx[1:]:
+                data_chunk = future.result()
+                future = pool.submit(self._load_chunk, i0)
+                yield data_chunk
+            yield future.result()
+
     def __iter__(self):
         worker_info = torch.utils.data.get_worker_info()
         idx = self.get_idx(self.n_chunks, worker_info)
-        offset = self.offset
-        for i0 in idx:
-            # Read in chunks
-            data_chunk = {}
-            for k in self.zs.data.keys():
-                data_chunk[k] = self.zs.data[k][
-                    offset + i0 * self.chunk_size : offset + (i0 + 1) * self.chunk_size
-                ]
-            n = len(data_chunk[k])
+        if self.batch_size is not None:
+            pin_memory = (
+                self.pin_memory and worker_info is None and torch.cuda.is_available()
+            )
+            yield from self._iter_batches(idx, pin_memory)
+            return
+        for data_chunk in self._iter_chunks(idx):
+            n = len(next(iter(data_chunk.values())))
 
             # Return separate samples
             for i in np.random.permutation(n):
@@ -409,6 +596,30 @@ class ZarrStoreIterableDataset(torch.utils.data.dataloader.IterableDataset):
                     out = self.on_after_load_sample(out)
                 yield out
 
+    def _iter_batches(self, idx, pin_memory=False):
+        bs = self.batch_size
+        rest, n_rest = None, 0
+        for data_chunk in self._iter_chunks(idx):
+            n = len(next(iter(data_chunk.values())))
+
+            # Shuffle once per chunk, and prepend what is left of the last one
+            perm = torch.from_numpy(np.random.permutation(n))
+            data_chunk = {k: torch.from_numpy(v)[perm] for k, v in data_chunk.items()}
+            if n_rest > 0:
+                data_chunk = {k: torch.cat([rest[k], v]) for k, v in data_chunk.items()}
+                n += n_rest
+            if pin_memory:
+                # Batches are views into the chunk, and stay pinned
+                data_chunk = {k: v.pin_memory() for k, v in data_chunk.items()}
+
+            n_full = n - n % bs
+            for j in range(0, n_full, bs):
+                yield {k: v[j : j + bs] for k, v in data_chunk.items()}
+            rest, n_rest = {k: v[n_full:] for k, v in data_chunk.items()}, n - n_full
+
+        if n_rest > 0 and not self.drop_last:
+            yield rest
+
 
 # def get_ntrain_nvalid(
 #    validation_amount: Union[float, int], len_dataset: int
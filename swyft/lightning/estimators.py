@@ -1,3 +1,5 @@
+import functools
+import warnings
 from typing import (
     Callable,
     Dict,
@@ -19,30 +21,55 @@ from swyft.lightning.core import *
 
 def equalize_tensors(a, b):
     """Equalize tensors, for matching minibatch size of A and B."""
-    n, m = len(a), len(b)
+    n = a.shape[0]
+    m = b.shape[0]
     if n == m:
         return a, b
-    elif n == 1:
-        shape = list(a.shape)
-        shape[0] = m
-        return a.expand(*shape), b
+    elif n == 1:  # Broadcast views, no copies
+        return a.expand(m, *a.shape[1:]), b
     elif m == 1:
-        shape = list(b.shape)
-        shape[0] = n
-        return a, b.expand(*shape)
+        return a, b.expand(n, *b.shape[1:])
     elif n < m:
         assert m % n == 0, "Cannot equalize tensors with non-divisible batch sizes."
-        shape = [1 for _ in range(a.dim())]
-        shape[0] = m // n
-        return a.repeat(*shape), b
+        return a.repeat(m // n, *(1,) * (a.dim() - 1)), b
     else:
         assert n % m == 0, "Cannot equalize tensors with non-divisible batch sizes."
-        shape = [1 for _ in range(b.dim())]
-        shape[0] = n // m
-        return a, b.repeat(*shape)
+        return a, b.repeat(n // m, *(1,) * (b.dim() - 1))
 
 
-class LogRatioEstimator_Ndim(torch.nn.Module):
+class _CompiledClassifierMixin:
+    """Optionally runs `self.classifier` through torch.compile.
+
+    Compilation is done lazily on first use (and skipped for torch < 2.0).
+    The compiled function is neither a submodule nor pickled, so state dicts
+    and pickling are unaffected.
+    """
+
+    def _get_classifier(self):
+        if not getattr(self, "_use_compile", False) or not hasattr(torch, "compile"):
+            return self.classifier
+        if self.__dict__.get("_classifier_compiled") is None:
+            self._classifier_compiled = torch.compile(self.classifier.forward)
+        return self._classifier_compiled
+
+    def __getstate__(self):
+        # Older torch/Python versions do not define Module.__getstate__
+        getstate = getattr(super(), "__getstate__", None)
+        state = dict(getstate() if getstate is not None else self.__dict__)
+        state.pop("_classifier_compiled", None)
+        return state
+
+
+def _lerp_(tensors, ends, weight):
+    """In-place tensor <- (1 - weight) * tensor + weight * end, for all tensors."""
+    if hasattr(torch, "_foreach_lerp_"):
+        torch._foreach_lerp_(tensors, ends, weight)
+    else:
+        for t, e in zip(tensors, ends):
+            t.lerp_(e, weight)
+
+
+class LogRatioEstimator_Ndim(_CompiledClassifierMixin, torch.nn.Module):
     """Channeled MLPs for estimating multi-dimensional posteriors."""
 
     def __init__(
@@ -54,6 +81,7 @@ class LogRatioEstimator_Ndim(torch.nn.Module):
         hidden_features=64,
         num_blocks=2,
         Lmax=0,
+        use_compile=False,
     ):
         super().__init__()
         self.marginals = marginals
@@ -76,11 +104,12 @@ class LogRatioEstimator_Ndim(torch.nn.Module):
             for marg in marginals:
                 varnames.append([basename + "[%i]" % i for i in marg])
         self.varnames = varnames
+        self._use_compile = use_compile
 
     def forward(self, x, z):
         x, z = equalize_tensors(x, z)
         z = self.ptrans(z)
-        ratios = self.classifier(x, z)
+        ratios = self._get_classifier()(x, z)
         w = LogRatioSamples(
             ratios,
             z,
@@ -163,13 +192,14 @@ class _RatioEstimatorMLP1d(torch.nn.Module):
 
     def forward(self, x, z):
         x, z = equalize_tensors(x, z)
-        zt = self.ptrans(z).detach()
+        with torch.no_grad():
+            zt = self.ptrans(z)
         logratios = self.classifier(x, zt)
         w = LogRatioSamples(logratios, z, self.varnames, metadata={"type": "MLP1d"})
         return w
 
 
-class LogRatioEstimator_1dim(torch.nn.Module):
+class LogRatioEstimator_1dim(_CompiledClassifierMixin, torch.nn.Module):
     """Channeled MLPs for estimating one-dimensional posteriors.
 
     Args:
@@ -187,6 +217,7 @@ class LogRatioEstimator_1dim(torch.nn.Module):
         use_batch_norm=True,
         ptrans_online_z_score=True,
         Lmax=0,
+        use_compile=False,
     ):
         """
         Default module for estimating 1-dim marginal posteriors.
@@ -195,6 +226,7 @@ class LogRatioEstimator_1dim(torch.nn.Module):
             num_features: Length of feature vector.
             num_params: Length of parameter vector.
             varnames: List of name of parameter vector. If a single string is provided, indices are attached automatically.
+            use_compile: Compile the classifier with torch.compile (ignored for torch < 2.0).
         """
         super().__init__()
         self.marginals = [(i,) for i in range(num_params)]
@@ -218,17 +250,45 @@ class LogRatioEstimator_1dim(torch.nn.Module):
             self.varnames = np.array(
                 [[varnames + "[%i]" % i] for i in range(num_params)]
             )
+        self._use_compile = use_compile
 
     def forward(self, x, z):
         x, z = equalize_tensors(x, z)
-        zt = self.ptrans(z).detach()
-        logratios = self.classifier(x, zt)
+        with torch.no_grad():
+            zt = self.ptrans(z)
+        logratios = self._get_classifier()(x, zt)
         w = LogRatioSamples(
             logratios, z.unsqueeze(-1), self.varnames, metadata={"type": "MLP1d"}
         )
         return w
 
 
+def _gaussian_logratios(xb, zb, rho):
+    """Log-ratio of a bivariate normal with correlation rho and standardized
+    marginals."""
+    rho2 = rho * rho
+    inv = torch.reciprocal(1 - rho2)
+    return (
+        -0.5 * torch.log1p(-rho2)
+        + rho * inv * xb * zb
+        - 0.5 * rho2 * inv * (xb * xb + zb * zb)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_gaussian_logratios():
+    """Returns `_gaussian_logratios` scripted with TorchScript, so that the
+    elementwise chain can be fused.  Scripted on first use, and falls back to
+    the eager function if scripting is not available."""
+    try:
+        with warnings.catch_warnings():
+            # Recent torch versions flag torch.jit as deprecated
+            warnings.simplefilter("ignore", FutureWarning)
+            return torch.jit.script(_gaussian_logratios)
+    except Exception:
+        return _gaussian_logratios
+
+
 class LogRatioEstimator_1dim_Gaussian(torch.nn.Module):
     """Estimating posteriors assuming that they are Gaussian.
 
@@ -274,62 +334,45 @@ class LogRatioEstimator_1dim_Gaussian(torch.nn.Module):
                 [[varnames + "[%i]" % i] for i in range(num_params)]
             )
 
+    @torch.no_grad()
+    def _update_stats(self, x, z):
+        # Estimation w/o Bessel's correction, using simple MLE estimate (https://en.wikipedia.org/wiki/Estimation_of_covariance_matrices)
+        # Only the first len(x) samples of z are jointly drawn with x
+        z = z[: len(x)]
+        x_var_batch, x_mean_batch = torch.var_mean(x, dim=0, unbiased=False)
+        z_var_batch, z_mean_batch = torch.var_mean(z, dim=0, unbiased=False)
+        xz_cov_batch = ((x - x_mean_batch) * (z - z_mean_batch)).mean(dim=0)
+
+        # Momentum-based update rule
+        batch_stats = [
+            x_mean_batch,
+            x_var_batch,
+            z_mean_batch,
+            z_var_batch,
+            xz_cov_batch,
+        ]
+        if self.x_mean is None:
+            self.x_mean, self.x_var, self.z_mean, self.z_var, self.xz_cov = batch_stats
+        else:
+            stats = [self.x_mean, self.x_var, self.z_mean, self.z_var, self.xz_cov]
+            _lerp_(stats, batch_stats, self.momentum)
+
     def forward(self, x: torch.Tensor, z: torch.Tensor) -> torch.Tensor:
         """2-dim Gaussian approximation to marginals and joint, assuming (B, N)."""
         if self.training or self.x_mean is None:
-            batch_size = len(x)
-            idx = np.arange(batch_size)
-
-            # Estimation w/o Bessel's correction, using simple MLE estimate (https://en.wikipedia.org/wiki/Estimation_of_covariance_matrices)
-            x_mean_batch = x[idx].mean(dim=0).detach()
-            z_mean_batch = z[idx].mean(dim=0).detach()
-            x_var_batch = ((x[idx] - x_mean_batch) ** 2).mean(dim=0).detach()
-            z_var_batch = ((z[idx] - z_mean_batch) ** 2).mean(dim=0).detach()
-            xz_cov_batch = (
-                ((x[idx] - x_mean_batch) * (z[idx] - z_mean_batch)).mean(dim=0).detach()
-            )
-
-            # Momentum-based update rule
-            momentum = self.momentum
-            self.x_mean = (
-                x_mean_batch
-                if self.x_mean is None
-                else (1 - momentum) * self.x_mean + momentum * x_mean_batch
-            )
-            self.x_var = (
-                x_var_batch
-                if self.x_var is None
-                else (1 - momentum) * self.x_var + momentum * x_var_batch
-            )
-            self.z_mean = (
-                z_mean_batch
-                if self.z_mean is None
-                else (1 - momentum) * self.z_mean + momentum * z_mean_batch
-            )
-            self.z_var = (
-                z_var_batch
-                if self.z_var is None
-                else (1 - momentum) * self.z_var + momentum * z_var_batch
-            )
-            self.xz_cov = (
-                xz_cov_batch
-                if self.xz_cov is None
-                else (1 - momentum) * self.xz_cov + momentum * xz_cov_batch
-            )
+            self._update_stats(x, z)
 
         # log r(x, z) = log p(x, z)/p(x)/p(z), with covariance given by [[x_var, xz_cov], [xz_cov, z_var]]
         x, z = swyft.equalize_tensors(x, z)
-        xb = (x - self.x_mean) / self.x_var ** 0.5
-        zb = (z - self.z_mean) / self.z_var ** 0.5
-        rho = self.xz_cov / self.x_var ** 0.5 / self.z_var ** 0.5
+        x_rstd = self.x_var.rsqrt()
+        z_rstd = self.z_var.rsqrt()
+        xb = (x - self.x_mean) * x_rstd
+        zb = (z - self.z_mean) * z_rstd
+        rho = self.xz_cov * x_rstd * z_rstd
         rho = torch.clip(
             rho, min=-((1 - self.minstd ** 2) ** 0.5), max=(1 - self.minstd ** 2) ** 0.5
         )
-        logratios = (
-            -0.5 * torch.log(1 - rho ** 2)
-            + rho / (1 - rho ** 2) * xb * zb
-            - 0.5 * rho ** 2 / (1 - rho ** 2) * (xb ** 2 + zb ** 2)
-        )
+        logratios = _get_gaussian_logratios()(xb, zb, rho)
         out = LogRatioSamples(
             logratios, z.unsqueeze(-1), self.varnames, metadata={"type": "Gaussian1d"}
         )
@@ -1,3 +1,4 @@
+import os
 from abc import abstractmethod
 from typing import (
     Callable,
@@ -16,7 +17,6 @@ from tqdm.auto import tqdm
 import swyft
 import swyft.lightning.data
 from swyft.lightning.data import *
-from swyft.lightning.utils import collate_output
 
 
 #########
@@ -75,7 +75,9 @@ class Samples(dict):
         on_after_load_sample=None,
         repeat=None,
         num_workers=0,
-        pin_memory=False,
+        pin_memory=None,
+        persistent_workers=True,
+        prefetch_factor=2,
     ):
         """Generator function to directly generate a dataloader object.
 
@@ -84,12 +86,26 @@ class Samples(dict):
             shuffle: shuffle for dataloader
             on_after_load_sample: see `get_dataset`
             repeat: If not None, Wrap dataset in RepeatDatasetWrapper
+            num_workers: Number of worker processes.  Samples are kept in memory, so the default of 0 avoids inter-process overhead.  If None, min(8, number of CPUs) workers are used.
+            pin_memory: Use page-locked memory for faster host-to-GPU transfer.  If None, enabled when CUDA is available.
+            persistent_workers: Keep workers alive between epochs (only used if num_workers > 0)
+            prefetch_factor: Number of batches loaded in advance by each worker (only used if num_workers > 0)
         """
         dataset = self.get_dataset(on_after_load_sample=on_after_load_sample)
         if repeat is not None:
             dataset = swyft.lightning.data.RepeatDatasetWrapper(dataset, repeat=repeat)
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
         return torch.utils.data.DataLoader(
-            dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=pin_memory,
+            **swyft.lightning.data._get_loader_kwargs(dataset, batch_size, shuffle),
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            collate_fn=swyft.lightning.data._collate_samples,
+            **swyft.lightning.data._get_worker_kwargs(
+                num_workers, persistent_workers, prefetch_factor
+            ),
         )
 
 
@@ -115,20 +131,22 @@ class Node:
         self._mult_parnames = mult_parnames
         self._fn = fn
         self._inputs = inputs
+        self._lazy_inputs = [
+            i
+            for i, arg in enumerate(inputs)
+            if isinstance(arg, Node) or isinstance(arg, Switch)
+        ]
 
     def __repr__(self):
         return f"Node{self._parname, self._fn, self._inputs}"
 
     def evaluate(self, trace):
-        if self._parname in trace.keys():  # Nothing to do
+        if self._parname in trace:  # Nothing to do
             return trace[self._parname]
         else:
-            args = (
-                arg.evaluate(trace)
-                if (isinstance(arg, Node) or isinstance(arg, Switch))
-                else arg
-                for arg in self._inputs
-            )
+            args = list(self._inputs)
+            for i in self._lazy_inputs:
+                args[i] = args[i].evaluate(trace)
             result = self._fn(*args)
             if self._mult_parnames is None:
                 trace[self._parname] = result
@@ -147,7 +165,7 @@ class Switch:
         self._choice = choice
 
     def evaluate(self, trace):
-        if self._parname in trace.keys():  # Nothing to do
+        if self._parname in trace:  # Nothing to do
             return trace[self._parname]
         else:
             choice = self._choice.evaluate(trace)
@@ -168,7 +186,7 @@ class Graph:
         return "Graph(" + self.nodes.__repr__() + ")"
 
     def __setitem__(self, key, value):
-        if key not in self.nodes.keys():
+        if key not in self.nodes:
             self.nodes.__setitem__(key, value)
 
     def keys(self):
@@ -209,6 +227,48 @@ class Graph:
     def prefix(self, prefix):
         return GraphPrefixContextManager(self, prefix)
 
+    def compile(self, targets, conditions=()):
+        """Generate linear execution plan for evaluating targets.
+
+        Nodes are ordered as they would be visited by recursive evaluation, so
+        that the plan consumes random numbers in the same order.
+
+        Args:
+            targets: List of target sample variables.
+            conditions: Names of conditioned sample variables.
+
+        Returns:
+            List of evaluation steps, or None if the required part of the graph
+            contains switches (which can only be resolved at runtime).
+        """
+        plan = []
+        done = set(conditions)
+
+        def visit(node):
+            if node._parname in done:
+                return True
+            if not isinstance(node, Node):
+                return False
+            lazy = []
+            for i in node._lazy_inputs:
+                arg = node._inputs[i]
+                if not visit(arg):
+                    return False
+                lazy.append((i, arg._parname))
+            plan.append(
+                (node._fn, node._inputs, lazy, node._parname, node._mult_parnames)
+            )
+            if node._mult_parnames is None:
+                done.add(node._parname)
+            else:
+                done.update(node._mult_parnames)
+            return True
+
+        for target in targets:
+            if not visit(self[target]):
+                return None
+        return plan
+
 
 class GraphPrefixContextManager:
     def __init__(self, graph, prefix):
@@ -252,6 +312,7 @@ class Simulator:
 
     def __init__(self):
         self.graph = None
+        self._plans = {}
 
     #        self.build_graph(self.graph)
 
@@ -291,17 +352,31 @@ class Simulator:
     def _run(self, targets=None, conditions={}):
         if self.graph is None:
             self.graph = Graph()
+            self._plans = {}
             self.build(self.graph)
         conditions = conditions() if callable(conditions) else conditions
         conditions = self.transform_conditions(conditions)
         trace = dict(conditions)
-        if targets is None:
-            targets = self.graph.keys()
-        for target in targets:
-            self.graph[target].evaluate(trace)
+        plan = self._get_plan(targets, trace.keys())
+        if plan is None:
+            if targets is None:
+                targets = self.graph.keys()
+            for target in targets:
+                self.graph[target].evaluate(trace)
+        else:
+            _execute_plan(plan, trace)
         result = self.transform_samples(trace)
         return result
 
+    def _get_plan(self, targets, conditions):
+        """Return cached execution plan for given targets and condition names."""
+        key = (None if targets is None else tuple(targets), frozenset(conditions))
+        if key not in self._plans:
+            if targets is None:
+                targets = list(self.graph.keys())
+            self._plans[key] = self.graph.compile(targets, conditions)
+        return self._plans[key]
+
     def get_shapes_and_dtypes(self, targets: Optional[Sequence[str]] = None):
         """This function run the simulator once and collects information about
         shapes and data-types of the nodes of the computational graph.
@@ -340,13 +415,15 @@ class Simulator:
         if N is None:
             return Sample(self._run(targets, conditions))
 
-        out = []
-        for _ in tqdm(range(N), disable=not progress_bar):
+        out = None
+        for i in tqdm(range(N), disable=not progress_bar):
             result = self._run(targets, conditions)
             for key in exclude:
                 result.pop(key, None)
-            out.append(result)
-        out = collate_output(out)
+            if out is None:
+                out = _empty_output(result, N)
+            for key, value in result.items():
+                _set_output_row(out, key, i, value)
         out = Samples(out)
         return out
 
@@ -405,6 +482,64 @@ class SimulatorResampler:
         return sims
 
 
+def _execute_plan(plan, trace):
+    """Run the steps of an execution plan (see `Graph.compile`) and store the
+    results in trace."""
+    for fn, inputs, lazy, parname, mult_parnames in plan:
+        if lazy:
+            args = list(inputs)
+            for i, name in lazy:
+                args[i] = trace[name]
+        else:
+            args = inputs
+        result = fn(*args)
+        if mult_parnames is None:
+            trace[parname] = result
+        else:
+            for name, value in zip(mult_parnames, result):
+                trace[name] = value
+
+
+def _empty_output(sample, N):
+    """Pre-allocate collated tensors/arrays for N samples, using the shapes and
+    dtypes of the given (first) sample."""
+    out = {}
+    for key, value in sample.items():
+        if isinstance(value, torch.Tensor):
+            out[key] = torch.empty(
+                (N, *value.shape), dtype=value.dtype, device=value.device
+            )
+        else:
+            value = np.asarray(value)
+            out[key] = np.empty((N, *value.shape), dtype=value.dtype)
+    return out
+
+
+def _set_output_row(out, key, i, value):
+    """Write value into row i of out[key].
+
+    Like np.stack / torch.stack, the buffer dtype is promoted if needed, and
+    the shape of value must match the shape of the other samples.
+    """
+    buf = out[key]
+    if isinstance(buf, torch.Tensor):
+        value = torch.as_tensor(value)
+        dtype = torch.promote_types(buf.dtype, value.dtype)
+        cast = buf.to
+    else:
+        value = np.asarray(value)
+        dtype = np.promote_types(buf.dtype, value.dtype)
+        cast = buf.astype
+    if tuple(value.shape) != tuple(buf.shape[1:]):
+        raise ValueError(
+            "Inconsistent shapes for '%s': %s and %s"
+            % (key, tuple(buf.shape[1:]), tuple(value.shape))
+        )
+    if dtype != buf.dtype:
+        buf = out[key] = cast(dtype)
+    buf[i] = value
+
+
 # class Trace(dict):
 #    """Defines the computational graph (DAG) and keeps track of simulation results."""
 #
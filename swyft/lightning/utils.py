@@ -145,10 +145,7 @@ def _get_weights(logratios, normalize: bool = False):
         normalize: If true, normalize weights to sum to one.  If false, return weights = exp(logratios).
     """
     if normalize:
-        logratio_max = logratios.max(axis=0).values
-        weights = torch.exp(logratios - logratio_max)
-        weights_total = weights.sum(axis=0)
-        weights = weights / weights_total * len(weights)
+        weights = torch.softmax(logratios, dim=0) * len(logratios)
     else:
         weights = torch.exp(logratios)
     return weights
@@ -369,36 +366,64 @@ def to_numpy(*args, single_precision=False):
         return tuple(result)
 
     x = args[0]
+    fn = _TO_NUMPY.get(type(x))
+    if fn is None:  # Subclasses, e.g. swyft.Samples
+        fn = _get_to_numpy_fn(x)
+    return fn(x, single_precision)
 
-    if isinstance(x, torch.Tensor):
-        if not single_precision:
-            return x.detach().cpu().numpy()
-        else:
-            x = x.detach().cpu()
-            if x.dtype == torch.float64:
-                x = x.float().numpy()
-            else:
-                x = x.numpy()
-            return x
-    elif isinstance(x, swyft.Samples):
-        return swyft.Samples(
-            {k: to_numpy(v, single_precision=single_precision) for k, v in x.items()}
-        )
-    elif isinstance(x, tuple):
-        return tuple(to_numpy(v, single_precision=single_precision) for v in x)
-    elif isinstance(x, list):
-        return [to_numpy(v, single_precision=single_precision) for v in x]
-    elif isinstance(x, dict):
-        return {k: to_numpy(v, single_precision=single_precision) for k, v in x.items()}
-    elif isinstance(x, np.ndarray):
-        if not single_precision:
-            return x
-        else:
-            if x.dtype == np.float64:
-                x = np.float32(x)
-            return x
-    else:
-        return x
+
+def _tensor_to_numpy(x, single_precision):
+    x = x.detach()
+    if single_precision and x.dtype == torch.float64:
+        x = x.float()
+    return x.cpu().numpy()
+
+
+def _array_to_numpy(x, single_precision):
+    if single_precision and x.dtype == np.float64:
+        x = np.float32(x)
+    return x
+
+
+def _samples_to_numpy(x, single_precision):
+    return swyft.Samples(
+        {k: to_numpy(v, single_precision=single_precision) for k, v in x.items()}
+    )
+
+
+def _tuple_to_numpy(x, single_precision):
+    return tuple(to_numpy(v, single_precision=single_precision) for v in x)
+
+
+def _list_to_numpy(x, single_precision):
+    return [to_numpy(v, single_precision=single_precision) for v in x]
+
+
+def _dict_to_numpy(x, single_precision):
+    return {k: to_numpy(v, single_precision=single_precision) for k, v in x.items()}
+
+
+def _identity_to_numpy(x, single_precision):
+    return x
+
+
+# Dispatch on exact type; order matters for the isinstance fallback
+_TO_NUMPY = {
+    torch.Tensor: _tensor_to_numpy,
+    tuple: _tuple_to_numpy,
+    list: _list_to_numpy,
+    dict: _dict_to_numpy,
+    np.ndarray: _array_to_numpy,
+}
+
+
+def _get_to_numpy_fn(x):
+    if isinstance(x, swyft.Samples):
+        return _samples_to_numpy
+    for t, fn in _TO_NUMPY.items():
+        if isinstance(x, t):
+            return fn
+    return _identity_to_numpy
 
 
 def to_numpy32(*args):
@@ -406,7 +431,11 @@ def to_numpy32(*args):
 
 
 def to_torch(x):
-    if isinstance(x, swyft.Samples):
+    if isinstance(x, torch.Tensor):
+        return x
+    elif isinstance(x, np.ndarray):
+        return torch.from_numpy(x)  # Shares memory with x
+    elif isinstance(x, swyft.Samples):
         return swyft.Samples({k: to_torch(v) for k, v in x.items()})
     elif isinstance(x, dict):
         return {k: to_torch(v) for k, v in x.items()}
@@ -416,13 +445,13 @@ def to_torch(x):
 
 def collate_output(out):
     """Turn list of tensors/arrays-value dicts into dict of collated tensors or arrays"""
-    keys = out[0].keys()
     result = {}
-    for key in keys:
-        if isinstance(out[0][key], torch.Tensor):
-            result[key] = torch.stack([x[key] for x in out])
-        else:
-            result[key] = np.stack([x[key] for x in out])
+    for key, value in out[0].items():
+        column = [x[key] for x in out]
+        if isinstance(value, torch.Tensor):
+            result[key] = torch.utils.data.dataloader.default_collate(column)
+        else:  # default_collate would turn arrays into tensors
+            result[key] = np.stack(column)
     return result
 
 
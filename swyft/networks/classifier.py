@@ -91,6 +91,9 @@ class ParameterTransform(nn.Module):
 
     def forward(self, parameters: torch.Tensor) -> torch.Tensor:
         parameters = self.online_z_score(parameters)
+        if parameters.dim() == 2:
+            # Single gather with the precomputed index buffer
+            return parameters[:, self.marginal_indices]  # B, M, P
         return self.get_marginal_block(parameters, self.marginal_indices)  # B, M, P
 
     @property
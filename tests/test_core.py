@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import swyft
+from swyft.lightning.core import LossAggregationSteps, _calc_mass
+
+
+class BilinearLoss(LossAggregationSteps):
+    """Minimal network with fixed log-ratios f(x, z) = x @ W @ z."""
+
+    def __init__(self):
+        self.W = torch.randn(3, 2)
+
+    def __call__(self, A, B):
+        x = A["x"].repeat(len(B["z"]) // len(A["x"]), 1)
+        logratios = (x @ self.W * B["z"]).reshape(len(x), -1)
+        return swyft.LogRatioSamples(logratios, B["z"], np.array([["z0"], ["z1"]]))
+
+
+def _reference_loss(net, A, B):
+    z = torch.cat([A["z"], B["z"]])
+    logratios = net(A, dict(z=z)).logratios
+    y = torch.zeros_like(logratios)
+    y[: len(A["z"])] = 1
+    num_neg = len(B["z"])
+    pos_weight = torch.ones_like(logratios[0]) * num_neg / len(A["z"])
+    loss = F.binary_cross_entropy_with_logits(
+        logratios, y, reduction="none", pos_weight=pos_weight
+    )
+    return loss.sum() / num_neg - 2 * np.log(2.0) * logratios.shape[1]
+
+
+def test_calc_loss():
+    torch.manual_seed(0)
+    net = BilinearLoss()
+    A = dict(x=torch.randn(8, 3), z=torch.randn(8, 2))
+    B = dict(x=torch.randn(16, 3), z=torch.randn(16, 2))
+
+    # Single dataloader: contrastive samples are the rolled positive samples
+    rolled = {k: torch.roll(v, 1, dims=0) for k, v in A.items()}
+    for _ in range(2):  # Second call reuses the cached buffers
+        assert torch.allclose(net._calc_loss(A), _reference_loss(net, A, rolled))
+
+    # Two dataloaders: contrastive samples from the second one
+    assert torch.allclose(net._calc_loss([A, B]), _reference_loss(net, A, B))
+
+
+def _calc_mass_single(r0, r):
+    """Per-example mass computation, as used before batching."""
+    p = torch.exp(r - r.max(axis=0).values)
+    p /= p.sum(axis=0)
+    m = r > r0
+    return (p * m).sum(axis=0)
+
+
+def test_calc_mass():
+    torch.manual_seed(0)
+    r0 = torch.randn(5, 3)
+    r = torch.randn(5, 100, 3)
+    masses = _calc_mass(r0, r)
+    expected = torch.stack([_calc_mass_single(r0[i], r[i]) for i in range(5)])
+    assert masses.shape == (5, 3)
+    assert torch.allclose(masses, expected, atol=1e-6)
+    assert _calc_mass(r0, r, add_noise=True).shape == (5, 3)
@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+import swyft
+from swyft.lightning.data import _get_index_slices
+
+
+def test_get_index_slices():
+    slices = _get_index_slices([2, 3, 4, 7, 9, 10])
+    assert slices == [[[0, 3], [2, 5]], [[3, 4], [7, 8]], [[4, 6], [9, 11]]]
+    assert _get_index_slices(np.array([], dtype=int)) == []
+
+
+def _zarr_store(path, N=103, chunk_size=10):
+    zs = swyft.ZarrStore(str(path / "store.zarr"))
+    shapes, dtypes = dict(x=(2,), z=()), dict(x="f4", z="f8")
+    zs.init(N, chunk_size, shapes=shapes, dtypes=dtypes)
+
+    def sample(N, progress_bar=True):
+        return dict(x=np.random.randn(N, 2).astype("f4"), z=np.random.rand(N))
+
+    zs.simulate(sample, batch_size=7)
+    return zs
+
+
+def test_zarr_store_dataloader(tmp_path):
+    zs = _zarr_store(tmp_path)
+    assert zs.sims_required == 0
+
+    batches = list(zs.get_dataloader(batch_size=8, drop_last=False))
+    assert [len(b["x"]) for b in batches] == [8] * 12 + [7]
+    assert batches[0]["x"].dtype == torch.float32
+    z = torch.cat([b["z"] for b in batches]).numpy()
+    assert np.array_equal(np.sort(z), np.sort(zs["z"][:]))
+
+    batches = list(zs.get_dataloader(batch_size=8))
+    assert [len(b["x"]) for b in batches] == [8] * 12
+
+    batches = list(zs.get_dataloader(batch_size=8, on_after_load_sample=lambda s: s))
+    assert len(batches) == 12
+    assert batches[0]["x"].shape == (8, 2) and batches[0]["z"].shape == (8,)
+    assert batches[0]["z"].dtype == torch.float64
+
+
+def test_zarr_store_simulate_resumes(tmp_path):
+    zs = _zarr_store(tmp_path, N=30)
+    zs.reset_length(45)
+    assert zs.sims_required == 15
+
+    def sample(N, progress_bar=True):
+        return dict(x=np.ones((N, 2)), z=np.ones(N))
+
+    zs.simulate(sample, max_sims=5, batch_size=5)
+    assert zs.sims_required == 10
+
+    # A second handle on the same store fills some of the cached free slots
+    other = swyft.ZarrStore(str(tmp_path / "store.zarr"))
+    other.root["meta/sim_status"][40:45] = 1
+    zs.simulate(sample, batch_size=5)
+    assert zs.sims_required == 0
+    assert (zs["z"][30:40] == 1).all() and (zs["z"][40:45] == 0).all()
+    assert (zs.root["meta/sim_status"][:] == 1).all()
+
+
+def test_zarr_store_simulate_fragmented(tmp_path):
+    zs = _zarr_store(tmp_path, N=20, chunk_size=4)
+    status = zs.root["meta/sim_status"]
+    status.set_coordinate_selection([1, 2, 7, 13], 0)
+    zs.reset_length(20)  # Drop cached slots
+    zs.simulate(lambda N, progress_bar: dict(x=np.zeros((N, 2)), z=np.arange(N) + 1.0))
+    assert (status[:] == 1).all()
+    assert list(zs["z"].get_coordinate_selection([1, 2, 7, 13])) == [1, 2, 3, 4]
+
+
+def test_datamodule_split():
+    samples = swyft.Samples(z=np.arange(50.0)[:, None], x=np.zeros((50, 3)))
+    dm = swyft.SwyftDataModule(samples, val_fraction=0.2, batch_size=8, shuffle=True)
+    dm.setup("fit")
+    assert len(dm.dataset_train) == 40 and len(dm.dataset_val) == 10
+    z_train = torch.cat([b["z"] for b in dm.train_dataloader()])
+    z_val = torch.cat([b["z"] for b in dm.val_dataloader()])
+    assert len(z_train) == 40 and len(z_val) == 10
+    z = torch.cat([z_train, z_val]).flatten().sort().values
+    assert torch.equal(z, torch.arange(50.0, dtype=z.dtype))
+
+
+def test_samples_dataset_default_collate():
+    samples = swyft.Samples(z=np.arange(10.0)[:, None], x=np.ones((10, 3)))
+    dataset = samples.get_dataset()
+    for ds in [dataset, torch.utils.data.Subset(dataset, [9, 8, 7, 6, 5])]:
+        batch = next(iter(torch.utils.data.DataLoader(ds, batch_size=4)))
+        assert batch["x"].shape == (4, 3)
+    assert batch["z"].flatten().tolist() == [9, 8, 7, 6]
+
+    batch = next(iter(samples.get_dataloader(batch_size=4, shuffle=True)))
+    assert batch["x"].shape == (4, 3) and batch["z"].dtype == torch.float64
+    dl = samples.get_dataloader(batch_size=4, on_after_load_sample=lambda s: s)
+    assert [len(b["z"]) for b in dl] == [4, 4, 2]
+
+
+def test_samples_dataloader_string_column():
+    samples = swyft.Samples(z=np.arange(6.0)[:, None], name=np.array(list("abcdef")))
+    batch = next(iter(samples.get_dataloader(batch_size=3)))
+    assert batch["z"].flatten().tolist() == [0, 1, 2]
+    assert batch["name"] == ["a", "b", "c"]
+
+
+def test_zarr_store_simulate_reads_status_once_per_batch(tmp_path, monkeypatch):
+    zs = _zarr_store(tmp_path, N=30)
+    zs.reset_length(50)
+    reads = []
+    sims_required = swyft.ZarrStore.sims_required.fget
+
+    def counting(self):
+        reads.append(1)
+        return sims_required(self)
+
+    monkeypatch.setattr(swyft.ZarrStore, "sims_required", property(counting))
+    zs.simulate(
+        lambda N, progress_bar=True: dict(x=np.ones((N, 2)), z=np.ones(N)), batch_size=5
+    )
+    # Four batches plus the final check
+    assert len(reads) == 5
+
+
+def test_zarr_store_shared_between_handles(tmp_path):
+    a = _zarr_store(tmp_path, N=40)
+    a.reset_length(50)
+    calls = []
+
+    def sample(N, progress_bar=True):
+        calls.append(N)
+        return dict(x=np.ones((N, 2)), z=np.ones(N))
+
+    a.simulate(sample, max_sims=5, batch_size=5)
+    b = swyft.ZarrStore(str(tmp_path / "store.zarr"))
+    b.simulate(sample, batch_size=5)
+    assert a.sims_required == 0
+    a.simulate(sample, batch_size=5)
+    assert calls == [5, 5]
+
+    b.reset_length(60)
+    assert len(a) == 60 and a.sims_required == 10
@@ -0,0 +1,61 @@
+import copy
+import pickle
+import torch
+import swyft
+
+
+def test_logratio_estimator_use_compile():
+    torch.manual_seed(0)
+    x, z = torch.randn(8, 3), torch.randn(8, 2)
+    for net in [
+        swyft.LogRatioEstimator_1dim(3, 2, varnames="z", use_compile=True),
+        swyft.LogRatioEstimator_Ndim(3, [(0, 1)], varnames="z", use_compile=True),
+    ]:
+        net.eval()
+        eager = net.classifier(x, net.ptrans(z))
+        assert torch.allclose(net(x, z).logratios, eager, atol=1e-6)
+
+        # Compiled functions are dropped on pickling and rebuilt on first use
+        net2 = pickle.loads(pickle.dumps(net))
+        assert "_classifier_compiled" not in net2.__dict__
+        assert torch.allclose(net2(x, z).logratios, eager, atol=1e-6)
+        assert torch.allclose(copy.deepcopy(net)(x, z).logratios, eager, atol=1e-6)
+        assert not any("compiled" in k for k in net.state_dict())
+
+
+def test_gaussian_logratios_scripted():
+    from swyft.lightning.estimators import _gaussian_logratios, _get_gaussian_logratios
+
+    xb, zb, rho = torch.randn(5, 2), torch.randn(5, 2), torch.rand(2) * 1.8 - 0.9
+    expected = (
+        -0.5 * torch.log(1 - rho**2)
+        + rho / (1 - rho**2) * xb * zb
+        - 0.5 * rho**2 / (1 - rho**2) * (xb**2 + zb**2)
+    )
+    for fn in [_gaussian_logratios, _get_gaussian_logratios()]:
+        assert torch.allclose(fn(xb, zb, rho), expected, atol=1e-5)
+
+
+def test_gaussian_logratios_fallback(monkeypatch):
+    from swyft.lightning.estimators import _gaussian_logratios, _get_gaussian_logratios
+
+    def fail(fn):
+        raise RuntimeError("TorchScript not available")
+
+    monkeypatch.setattr(torch.jit, "script", fail)
+    _get_gaussian_logratios.cache_clear()
+    try:
+        assert _get_gaussian_logratios() is _gaussian_logratios
+    finally:
+        _get_gaussian_logratios.cache_clear()
+
+
+def test_parameter_transform_negative_index():
+    from swyft.networks.classifier import ParameterTransform
+
+    z = torch.arange(6.0).view(2, 3)
+    ptrans = ParameterTransform(3, [(0, -1)], False)
+    assert ptrans(z).tolist() == [[[2.0, 0.0]], [[5.0, 3.0]]]
+
+    net = swyft.LogRatioEstimator_Ndim(3, [(0, -1)], varnames="z")
+    assert net(torch.randn(2, 3), z).logratios.shape == (2, 1)
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 from scipy import stats
 import swyft
 
@@ -18,3 +19,53 @@ class Simulator(swyft.Simulator):
 def test_simulator():
     sim = Simulator()
     samples = sim.sample(N=10)
+    assert len(samples) == 10
+    assert samples["x"].shape == (10, 10)
+    assert samples["x"].dtype == np.float32
+
+
+def test_simulator_exclude():
+    sim = Simulator()
+    samples = sim.sample(N=5, exclude=["f"])
+    assert "f" not in samples.keys()
+    assert samples["z"].shape == (5, 2)
+
+
+def test_simulator_conditions():
+    sim = Simulator()
+    z = np.array([0.5, -0.5])
+    sample = sim.sample(conditions={"z": z}, targets=["f"])
+    assert np.allclose(sample["f"], z[0] + z[1] * sim.x)
+    assert "x" not in sample.keys()
+
+
+def test_samples_dataloader():
+    sim = Simulator()
+    samples = sim.sample(N=10)
+    batch = next(iter(samples.get_dataloader(batch_size=4)))
+    assert batch["x"].shape == (4, 10)
+    assert np.allclose(batch["x"].numpy(), samples["x"][:4])
+
+
+class ClippedSimulator(swyft.Simulator):
+    def __init__(self, z):
+        super().__init__()
+        self.z = iter(z)
+
+    def build(self, graph):
+        z = graph.node("z", lambda: next(self.z))
+        f = graph.node("f", lambda z: 0 if z < 0 else z, z)
+        x = graph.node("x", lambda z: np.zeros(1 if z < 0 else 2), z)
+
+
+def test_simulator_promotes_dtype():
+    sim = ClippedSimulator([-1.0, 1.64])
+    samples = sim.sample(N=2, targets=["f"])
+    assert samples["f"].dtype == np.float64
+    assert np.allclose(samples["f"], [0, 1.64])
+
+
+def test_simulator_inconsistent_shapes():
+    sim = ClippedSimulator([1.0, -1.0])
+    with pytest.raises(ValueError):
+        sim.sample(N=2)